@@ -0,0 +1,461 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import pdfplumber
+
+from main import (MAJOR_HEADINGS, FIELDS_TO_EXTRACT, WORD_X_TOLERANCE, WORD_Y_TOLERANCE,
+                  extract_data_from_pdf_v3, build_words_from_chars, new_extraction_metrics, np)
+
+"""
+Benchmark for extract_data_from_pdf_v3 using synthetic registration PDFs.
+
+Builds fake documents:
+    Writes PDFs that follow the MAJOR_HEADINGS / FIELDS_TO_EXTRACT layout, with made-up values,
+    so no real patient data is needed. Values can wrap (2_line, 3_line and value_below fields),
+    be left blank, and be followed by attachment pages.
+
+Times the extraction:
+    Reports docs/sec, latency percentiles of the pages actually read, and peak memory for each batch size.
+
+Checks the answers:
+    Compares every extracted value with the generated ground truth, so a speedup that breaks
+    accuracy shows up as a failed run (non-zero exit code).
+
+Checks the word engines:
+    With --check-word-engine, every page of the generated documents (and of any real PDFs in
+    --sample-dir) is turned into words by both page.extract_words and build_words_from_chars.
+    Any page where the two lists differ fails the run.
+"""
+
+# --- 1. SYNTHETIC LAYOUT ---
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+TOP_MARGIN = 40
+BOTTOM_MARGIN = 800
+LABEL_X = 40
+VALUE_X = 250
+FONT_SIZE = 10
+HEADING_FONT_SIZE = 12
+
+# Vertical spacing (points). These keep each value inside its finder's search box
+# and neighbouring values outside it, e.g. 2_line searches 15pt above and below its label.
+ROW_SPACING = 30
+WRAP_SPACING = 12
+HEADING_SPACING = 28
+VALUE_BELOW_GAP = 16
+VALUE_BELOW_SPACING = 70
+THREE_LINE_SPACING = 85
+
+WORD_POOL = [
+    "Smith", "Jones", "Taylor", "Brown", "Williams", "Wilson", "Johnson", "Davies", "Robinson",
+    "Wright", "Thompson", "Evans", "Walker", "White", "Roberts", "Green", "Hall", "Wood", "Jackson",
+    "Clarke", "Yes", "No", "Mother", "Friend", "Leeds", "York", "Hull", "Mill", "Lane", "Road",
+    "Court", "House", "Flat", "Unknown", "Asthma", "Eczema", "Weekly", "Daily", "British", "Irish",
+]
+FILLER_WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+
+def _excluded_tokens():
+    """
+    Every word used in a heading or label. Values never use these, so they
+    can't be mistaken for a label.
+    """
+    tokens = set()
+    for header in MAJOR_HEADINGS:
+        tokens.update(header.split())
+    for config in FIELDS_TO_EXTRACT.values():
+        for label_text in config["labels"]:
+            tokens.update(label_text.split())
+    return tokens
+
+SAFE_WORDS = [word for word in WORD_POOL if word not in _excluded_tokens()]
+
+
+def _value_line(rnd):
+    """
+    One line of a made-up value, e.g. "Walker 417".
+    """
+    words = [rnd.choice(SAFE_WORDS) for _ in range(rnd.randint(1, 2))]
+    if rnd.random() < 0.5:
+        words.append(str(rnd.randint(1, 9999)))
+    return " ".join(words)
+
+
+def build_document(rnd, wrap_probability, blank_probability, fields_per_page=None, extra_pages=0):
+    """
+    Lays out one synthetic registration form.
+
+    Returns (pages, ground_truth), where pages is a list of pages, each a list of
+    (x, top, font_size, text) lines, and ground_truth has the same
+    {section: {field: value}} shape as extract_data_from_pdf_v3's result.
+    """
+    fields_by_section = {}
+    for key, config in FIELDS_TO_EXTRACT.items():
+        fields_by_section.setdefault(config["section_header"], []).append((key, config))
+
+    pages = [[]]
+    ground_truth = {}
+    state = {"top": TOP_MARGIN, "fields_on_page": 0}
+
+    def reserve(height, is_field=False):
+        page_full = fields_per_page is not None and is_field and state["fields_on_page"] >= fields_per_page
+        if state["top"] + height > BOTTOM_MARGIN or page_full:
+            pages.append([])
+            state["top"] = TOP_MARGIN
+            state["fields_on_page"] = 0
+        if is_field:
+            state["fields_on_page"] += 1
+        return state["top"]
+
+    def write(x, top, text, font_size=FONT_SIZE):
+        pages[-1].append((x, top, font_size, text))
+
+    for header in MAJOR_HEADINGS:
+        fields = fields_by_section.get(header, [])
+        # "Safeguarding Flags" and "Ethnicity" are both a heading and the field's own label.
+        heading_is_label = any(config["labels"][0] == header for _, config in fields)
+        if not heading_is_label:
+            top = reserve(HEADING_SPACING)
+            write(LABEL_X, top, header, HEADING_FONT_SIZE)
+            state["top"] += HEADING_SPACING
+
+        for key, config in fields:
+            label_text = config["labels"][0]
+            multi_line_type = config.get("multi_line_type")
+            is_blank = rnd.random() < blank_probability
+            wraps = rnd.random() < wrap_probability
+
+            if multi_line_type == "value_below":
+                line_count = 2 if wraps else 1
+                top = reserve(VALUE_BELOW_SPACING, is_field=True)
+                write(LABEL_X, top, label_text, HEADING_FONT_SIZE)
+                value_lines = [] if is_blank else [_value_line(rnd) for _ in range(line_count)]
+                for n, line in enumerate(value_lines):
+                    write(LABEL_X, top + VALUE_BELOW_GAP + n * WRAP_SPACING, line)
+                state["top"] += VALUE_BELOW_SPACING
+            elif multi_line_type == "3_line":
+                line_count = rnd.randint(2, 3) if wraps else 1
+                top = reserve(THREE_LINE_SPACING, is_field=True)
+                write(LABEL_X, top, label_text, HEADING_FONT_SIZE if heading_is_label else FONT_SIZE)
+                value_lines = [] if is_blank else [_value_line(rnd) for _ in range(line_count)]
+                for n, line in enumerate(value_lines):
+                    write(VALUE_X, top + n * WRAP_SPACING, line)
+                state["top"] += THREE_LINE_SPACING
+            elif multi_line_type == "2_line":
+                line_count = 2 if wraps else 1
+                top = reserve(ROW_SPACING + (line_count - 1) * WRAP_SPACING, is_field=True)
+                write(LABEL_X, top, label_text)
+                value_lines = [] if is_blank else [_value_line(rnd) for _ in range(line_count)]
+                for n, line in enumerate(value_lines):
+                    write(VALUE_X, top + n * WRAP_SPACING, line)
+                state["top"] += ROW_SPACING + (line_count - 1) * WRAP_SPACING
+            else:
+                top = reserve(ROW_SPACING, is_field=True)
+                write(LABEL_X, top, label_text)
+                value_lines = [] if is_blank else [_value_line(rnd)]
+                for line in value_lines:
+                    write(VALUE_X, top, line)
+                state["top"] += ROW_SPACING
+
+            if value_lines:
+                ground_truth.setdefault(header, {})[key] = " ".join(value_lines)
+
+    for _ in range(extra_pages):
+        attachment = []
+        for top in range(TOP_MARGIN, BOTTOM_MARGIN, 14):
+            attachment.append((LABEL_X, top, FONT_SIZE, " ".join(rnd.choice(FILLER_WORDS) for _ in range(12))))
+        pages.append(attachment)
+
+    return pages, ground_truth
+
+
+# --- 2. MINIMAL PDF WRITER ---
+
+def _escape_pdf_text(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(pdf_path, pages):
+    """
+    Writes the pages as a plain PDF using the built-in Helvetica font, so no
+    PDF library is needed. 'top' is measured from the top of the page, like pdfplumber.
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_object_numbers = []
+    for lines in pages:
+        operations = []
+        for x, top, font_size, text in lines:
+            baseline = PAGE_HEIGHT - top - font_size
+            operations.append(f"BT /F1 {font_size} Tf {x} {baseline:.2f} Td ({_escape_pdf_text(text)}) Tj ET")
+        stream = "\n".join(operations).encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_number = len(objects)
+        objects.append((f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+                        f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_number} 0 R >>").encode())
+        page_object_numbers.append(len(objects))
+    kids = " ".join(f"{number} 0 R" for number in page_object_numbers)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_object_numbers)} >>".encode()
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref_offset = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+
+    with open(pdf_path, 'wb') as f:
+        f.write(output)
+
+
+def generate_batch(output_dir, doc_count, seed, wrap_probability, blank_probability, fields_per_page, extra_pages):
+    """
+    Writes doc_count synthetic PDFs and a ground_truth.json next to them.
+    Returns a list of (pdf_path, page_count, ground_truth).
+    """
+    rnd = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    batch = []
+    for n in range(doc_count):
+        pages, ground_truth = build_document(rnd, wrap_probability, blank_probability, fields_per_page, extra_pages)
+        pdf_path = os.path.join(output_dir, f"synthetic_{n:05d}.pdf")
+        write_pdf(pdf_path, pages)
+        batch.append((pdf_path, len(pages), ground_truth))
+    with open(os.path.join(output_dir, "ground_truth.json"), 'w', encoding='utf-8') as f:
+        json.dump({os.path.basename(pdf_path): truth for pdf_path, _, truth in batch}, f, indent=2)
+    return batch
+
+
+# --- 3. MEASUREMENT ---
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def compare_with_ground_truth(extracted, ground_truth):
+    """
+    Counts fields that match, are missing, have the wrong value, or were
+    extracted although the generator left them blank.
+    """
+    counts = {"correct": 0, "missing": 0, "wrong": 0, "unexpected": 0}
+    extracted = extracted or {}
+    for section, fields in ground_truth.items():
+        for key, value in fields.items():
+            found = extracted.get(section, {}).get(key)
+            if found is None:
+                counts["missing"] += 1
+            elif found == value:
+                counts["correct"] += 1
+            else:
+                counts["wrong"] += 1
+    for section, fields in extracted.items():
+        for key in fields:
+            if key not in ground_truth.get(section, {}):
+                counts["unexpected"] += 1
+    return counts
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB, or None where the platform can't report it.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def compare_word_engines(pdf_paths):
+    """
+    Builds the words of every page with both engines and compares them.
+    Returns the page count, the time each engine spent grouping chars into
+    words, and a list of "file page N" strings for pages that differ.
+    """
+    pages = 0
+    seconds = {"pdfplumber": 0.0, "fast": 0.0}
+    mismatched_pages = []
+    for pdf_path in pdf_paths:
+        with pdfplumber.open(pdf_path) as pdf:
+            for page_num, page in enumerate(pdf.pages, 1):
+                chars = page.chars  # Parse once so both timings cover only word grouping.
+                started = time.perf_counter()
+                expected = page.extract_words(x_tolerance=WORD_X_TOLERANCE, y_tolerance=WORD_Y_TOLERANCE)
+                seconds["pdfplumber"] += time.perf_counter() - started
+                started = time.perf_counter()
+                built = build_words_from_chars(chars)
+                seconds["fast"] += time.perf_counter() - started
+                pages += 1
+                if built != expected:
+                    mismatched_pages.append(f"{os.path.basename(pdf_path)} page {page_num}")
+                page.close()
+    return {"pages": pages, "seconds": seconds, "mismatched_pages": mismatched_pages}
+
+
+def run_benchmark(batch, memory_sample_size, word_engine="pdfplumber"):
+    """
+    Extracts every document in the batch, timing each one and checking it
+    against the ground truth. A small sample is then re-run under tracemalloc
+    to measure peak Python memory per document without slowing the timed pass.
+    """
+    page_latencies = []
+    totals = {"correct": 0, "missing": 0, "wrong": 0, "unexpected": 0}
+    mismatched_files = []
+
+    started = time.perf_counter()
+    for pdf_path, _, ground_truth in batch:
+        metrics = new_extraction_metrics()
+        extracted = extract_data_from_pdf_v3(pdf_path, FIELDS_TO_EXTRACT, verbose=False, word_engine=word_engine,
+                                             metrics=metrics)
+        # Real per-page timings from the profiling instrumentation. Pages skipped
+        # by early termination were never read, so they add no latency samples.
+        page_latencies.extend(page["extract_words"] + page["matching"] + page["find_value"]
+                              for page in metrics["pages"])
+
+        counts = compare_with_ground_truth(extracted, ground_truth)
+        for name, count in counts.items():
+            totals[name] += count
+        if counts["missing"] or counts["wrong"] or counts["unexpected"]:
+            mismatched_files.append(os.path.basename(pdf_path))
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    peak_traced = 0
+    for pdf_path, _, _ in batch[:memory_sample_size]:
+        tracemalloc.reset_peak()
+        extract_data_from_pdf_v3(pdf_path, FIELDS_TO_EXTRACT, verbose=False, word_engine=word_engine)
+        peak_traced = max(peak_traced, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    return {
+        "docs": len(batch),
+        "pages": sum(page_count for _, page_count, _ in batch),
+        "pages_read": len(page_latencies),
+        "seconds": elapsed,
+        "docs_per_sec": len(batch) / elapsed if elapsed > 0 else 0.0,
+        "page_ms_p50": percentile(page_latencies, 0.50) * 1000,
+        "page_ms_p90": percentile(page_latencies, 0.90) * 1000,
+        "page_ms_p99": percentile(page_latencies, 0.99) * 1000,
+        "peak_traced_mb_per_doc": peak_traced / (1024 * 1024),
+        "peak_rss_mb": peak_rss_mb(),
+        "fields": totals,
+        "mismatched_files": mismatched_files,
+    }
+
+
+# --- 4. MAIN EXECUTION ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark extract_data_from_pdf_v3 on synthetic registration PDFs.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[20],
+                        help="Number of documents in each benchmark batch.")
+    parser.add_argument("--wrap-probability", type=float, default=0.5,
+                        help="Chance that a 2_line, 3_line or value_below value spans more than one line.")
+    parser.add_argument("--blank-probability", type=float, default=0.1,
+                        help="Chance that a field is left empty.")
+    parser.add_argument("--fields-per-page", type=int, default=None,
+                        help="Start a new page after this many fields (default: fill each page).")
+    parser.add_argument("--extra-pages", type=int, default=0,
+                        help="Attachment pages of filler text appended to every document.")
+    parser.add_argument("--memory-sample", type=int, default=5,
+                        help="Documents re-run under tracemalloc to measure peak memory.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default=None,
+                        help="Keep the generated PDFs and ground truth here instead of a temporary folder.")
+    parser.add_argument("--json", dest="json_output", default=None,
+                        help="Also write the results to this JSON file.")
+    parser.add_argument("--word-engine", choices=["pdfplumber", "fast"], default="pdfplumber",
+                        help="Word engine used for the timed extraction.")
+    parser.add_argument("--check-word-engine", action="store_true",
+                        help="Also check that the fast word engine gives exactly the same words as pdfplumber.")
+    parser.add_argument("--sample-dir", default=None,
+                        help="Folder of real PDFs to include in --check-word-engine.")
+    args = parser.parse_args(argv)
+    if (args.word_engine == "fast" or args.check_word_engine) and np is None:
+        parser.error("the fast word engine requires NumPy (pip install numpy)")
+
+    work_dir = args.output_dir or tempfile.mkdtemp(prefix="registration_benchmark_")
+    all_stats = []
+    check_paths = []
+    engine_check = None
+    try:
+        for batch_size in args.batch_sizes:
+            batch_dir = os.path.join(work_dir, f"batch_{batch_size}")
+            batch = generate_batch(batch_dir, batch_size, args.seed, args.wrap_probability,
+                                   args.blank_probability, args.fields_per_page, args.extra_pages)
+            stats = run_benchmark(batch, args.memory_sample, args.word_engine)
+            stats["batch_size"] = batch_size
+            all_stats.append(stats)
+            check_paths += [pdf_path for pdf_path, _, _ in batch]
+
+        if args.check_word_engine:
+            if args.sample_dir:
+                check_paths += sorted(os.path.join(args.sample_dir, filename)
+                                      for filename in os.listdir(args.sample_dir)
+                                      if filename.lower().endswith('.pdf'))
+            engine_check = compare_word_engines(check_paths)
+    finally:
+        if not args.output_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'batch':>6} {'pages':>6} {'read':>6} {'docs/sec':>9} {'p50 ms/pg':>10} {'p90 ms/pg':>10} {'p99 ms/pg':>10} "
+          f"{'peak MB/doc':>12} {'peak RSS MB':>12} {'accuracy':>9}")
+    failed = False
+    for stats in all_stats:
+        fields = stats["fields"]
+        expected = fields["correct"] + fields["missing"] + fields["wrong"]
+        accuracy = fields["correct"] / expected if expected else 1.0
+        rss = f"{stats['peak_rss_mb']:.1f}" if stats["peak_rss_mb"] is not None else "n/a"
+        print(f"{stats['batch_size']:>6} {stats['pages']:>6} {stats['pages_read']:>6} {stats['docs_per_sec']:>9.2f} {stats['page_ms_p50']:>10.1f} "
+              f"{stats['page_ms_p90']:>10.1f} {stats['page_ms_p99']:>10.1f} {stats['peak_traced_mb_per_doc']:>12.1f} "
+              f"{rss:>12} {accuracy:>8.1%}")
+        if stats["mismatched_files"]:
+            failed = True
+            print(f"  Ground truth mismatch in {len(stats['mismatched_files'])} file(s): "
+                  f"{fields['missing']} missing, {fields['wrong']} wrong, {fields['unexpected']} unexpected "
+                  f"(e.g. {', '.join(stats['mismatched_files'][:3])})")
+
+    if engine_check:
+        seconds = engine_check["seconds"]
+        speedup = seconds["pdfplumber"] / seconds["fast"] if seconds["fast"] > 0 else 0.0
+        print(f"\nWord engine check: {engine_check['pages']} page(s), pdfplumber {seconds['pdfplumber']:.3f}s, "
+              f"fast {seconds['fast']:.3f}s ({speedup:.1f}x).")
+        if engine_check["mismatched_pages"]:
+            failed = True
+            print(f"  Words differ on {len(engine_check['mismatched_pages'])} page(s) "
+                  f"(e.g. {', '.join(engine_check['mismatched_pages'][:3])})")
+
+    if args.json_output:
+        with open(args.json_output, 'w', encoding='utf-8') as f:
+            json.dump(all_stats, f, indent=2)
+        print(f"\nResults saved to '{args.json_output}'.")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,27 @@
 import pdfplumber
+import io
 import os
+import csv
+import sys
 import json
+import time
+import signal
+import sqlite3
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from bisect import bisect_left, bisect_right
+from pdfplumber.utils import extract_words as pdfplumber_extract_words
+from pdfplumber.utils.text import LIGATURES
+from pdfminer.pdfdocument import PDFPasswordIncorrect
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the "fast" word engine
+    np = None
 
 """
 Uses a "shopping list": 
@@ -158,9 +179,121 @@ FIELDS_TO_EXTRACT = {
     "eligible_for_dispensing": {"labels": ["Eligible for dispensing"], "section_header": "Dispensing Patient"}
 }
 
+# Bump this whenever the extraction logic changes in a way that alters results,
+# so cached results from older versions are no longer used.
+EXTRACTOR_VERSION = "3.1"
+
 # --- 2. CORE EXTRACTION LOGIC ---
 
-def find_value_singleline(anchor_last_word, all_words_on_page, page_width):
+# The word grouping tolerances used for every page.
+WORD_X_TOLERANCE = 2
+WORD_Y_TOLERANCE = 2
+
+def build_words_from_chars(chars, x_tolerance=WORD_X_TOLERANCE, y_tolerance=WORD_Y_TOLERANCE):
+    """
+    Fast replacement for pdfplumber's extract_words on our forms. The chars are
+    read into NumPy arrays, grouped into lines by clustering their 'top' values,
+    and split into words wherever pdfplumber would split them: at whitespace,
+    at a horizontal gap wider than x_tolerance, when a char starts left of the
+    previous one, or at a vertical jump over y_tolerance.
+
+    Returns the same word dictionaries, in the same order, as
+    page.extract_words(x_tolerance=..., y_tolerance=...). Pages with rotated
+    text, or a missing NumPy, use pdfplumber's own word extraction instead.
+    """
+    if not chars:
+        return []
+    if np is None or not all(char["upright"] for char in chars):
+        return pdfplumber_extract_words(chars, x_tolerance=x_tolerance, y_tolerance=y_tolerance)
+
+    count = len(chars)
+    x0 = np.fromiter((char["x0"] for char in chars), float, count)
+    x1 = np.fromiter((char["x1"] for char in chars), float, count)
+    top = np.fromiter((char["top"] for char in chars), float, count)
+    bottom = np.fromiter((char["bottom"] for char in chars), float, count)
+    is_space = np.fromiter(((char["text"] or "").isspace() for char in chars), bool, count)
+
+    # Lines: chained clusters of 'top' values no more than y_tolerance apart.
+    distinct_tops = np.unique(top)
+    starts_line = np.ones(len(distinct_tops), bool)
+    starts_line[1:] = distinct_tops[1:] > distinct_tops[:-1] + y_tolerance
+    line = (np.cumsum(starts_line) - 1)[np.searchsorted(distinct_tops, top)]
+
+    # Line by line, left to right; lexsort is stable, like pdfplumber's sorts.
+    order = np.lexsort((x0, line))
+    x0, x1, top, bottom, is_space, line = (values[order] for values in (x0, x1, top, bottom, is_space, line))
+
+    starts_word = np.ones(count, bool)
+    starts_word[1:] = ((line[1:] != line[:-1])
+                       | is_space[:-1]
+                       | (x0[1:] < x0[:-1])
+                       | (x0[1:] > x1[:-1] + x_tolerance)
+                       | (np.abs(top[1:] - top[:-1]) > y_tolerance))
+    keep = ~is_space
+    order, x0, x1, top, bottom, starts_word = (values[keep] for values in (order, x0, x1, top, bottom, starts_word))
+    if not len(order):
+        return []
+
+    word_starts = np.flatnonzero(starts_word)
+    word_x0 = np.minimum.reduceat(x0, word_starts).tolist()
+    word_x1 = np.maximum.reduceat(x1, word_starts).tolist()
+    word_top = np.minimum.reduceat(top, word_starts).tolist()
+    word_bottom = np.maximum.reduceat(bottom, word_starts).tolist()
+
+    ordered_chars = [chars[n] for n in order.tolist()]
+    bounds = word_starts.tolist() + [len(ordered_chars)]
+    words = []
+    for n in range(len(word_starts)):
+        word_chars = ordered_chars[bounds[n]:bounds[n + 1]]
+        first_char = word_chars[0]
+        words.append({
+            "text": "".join(LIGATURES.get(char["text"], char["text"] or "") for char in word_chars),
+            "x0": word_x0[n],
+            "x1": word_x1[n],
+            "top": word_top[n],
+            "doctop": word_top[n] + (first_char["doctop"] - first_char["top"]),
+            "bottom": word_bottom[n],
+            "upright": first_char["upright"],
+            "height": word_bottom[n] - word_top[n],
+            "width": word_x1[n] - word_x0[n],
+            "direction": "ltr",
+        })
+    return words
+
+def extract_page_words(page, word_engine="pdfplumber"):
+    """
+    Turns a page (or filtered page) into words with the chosen engine:
+    "pdfplumber" (page.extract_words) or "fast" (build_words_from_chars).
+    """
+    if word_engine == "fast":
+        return build_words_from_chars(page.chars)
+    return page.extract_words(x_tolerance=WORD_X_TOLERANCE, y_tolerance=WORD_Y_TOLERANCE)
+
+def build_word_index(page_words):
+    """
+    Builds a spatial index over the words of a page, sorted by their 'top'
+    coordinate, so the value finders only look at words in a band of rows
+    instead of scanning the whole page for every label.
+    """
+    positions = sorted(range(len(page_words)), key=lambda n: page_words[n]['top'])
+    return {
+        "words": page_words,
+        "positions": positions,
+        "tops": [page_words[n]['top'] for n in positions],
+        "max_height": max((w['bottom'] - w['top'] for w in page_words), default=0),
+    }
+
+def query_word_index(word_index, top_min, top_max):
+    """
+    Returns the words whose 'top' lies within [top_min, top_max], in their
+    original page order. Callers still apply their exact bounds to the result.
+    """
+    start = bisect_left(word_index["tops"], top_min)
+    end = bisect_right(word_index["tops"], top_max)
+    words = word_index["words"]
+    return [words[n] for n in sorted(word_index["positions"][start:end])]
+
+def find_value_singleline(anchor_last_word, word_index, page_width):
     """
     Finds a value strictly on the same line as its label.
     This is the default, precise method for most fields.
@@ -170,8 +303,11 @@ def find_value_singleline(anchor_last_word, all_words_on_page, page_width):
     anchor_bottom = anchor_last_word['bottom']
     search_x_start = anchor_last_word['x1'] + 2
     search_x_end = page_width * 0.95
+    # A word's vertical centre can only fall in the band if its top is at most
+    # one word height above it.
+    candidate_words = query_word_index(word_index, anchor_top - v_tolerance - word_index["max_height"], anchor_bottom + v_tolerance)
     value_words = []
-    for word in all_words_on_page:
+    for word in candidate_words:
         word_v_center = (word['top'] + word['bottom']) / 2
         is_vertically_aligned = (word_v_center > anchor_top - v_tolerance and word_v_center < anchor_bottom + v_tolerance)
         is_horizontally_placed = (word['x0'] > search_x_start and word['x0'] < search_x_end)
@@ -183,7 +319,7 @@ def find_value_singleline(anchor_last_word, all_words_on_page, page_width):
         return full_value.strip()
     return None
 
-def find_value_2_lines(anchor_last_word, all_words_on_page, page_width):
+def find_value_2_lines(anchor_last_word, word_index, page_width):
     """
     For fields that may wrap to a second line next to the label.
     """
@@ -192,7 +328,7 @@ def find_value_2_lines(anchor_last_word, all_words_on_page, page_width):
     search_y_start = anchor_last_word['top'] - 15 # Look up to 15px above the label
     search_y_end = anchor_last_word['bottom'] + 15
     value_words = []
-    for word in all_words_on_page:
+    for word in query_word_index(word_index, search_y_start, search_y_end):
         is_horizontally_placed = word['x0'] > search_x_start and word['x0'] < search_x_end
         is_vertically_placed = word['top'] > search_y_start and word['top'] < search_y_end
         if is_horizontally_placed and is_vertically_placed:
@@ -201,7 +337,7 @@ def find_value_2_lines(anchor_last_word, all_words_on_page, page_width):
     value_words.sort(key=lambda w: (w['top'], w['x0']))
     return " ".join(w['text'] for w in value_words).strip()
 
-def find_value_3_lines(anchor_last_word, all_words_on_page, page_width):
+def find_value_3_lines(anchor_last_word, word_index, page_width):
     """
     For fields that may wrap to a second line next to the label.
     """
@@ -210,7 +346,7 @@ def find_value_3_lines(anchor_last_word, all_words_on_page, page_width):
     search_y_start = anchor_last_word['top'] - 20  # Look up to 20px above the label
     search_y_end = anchor_last_word['bottom'] + 60
     value_words = []
-    for word in all_words_on_page:
+    for word in query_word_index(word_index, search_y_start, search_y_end):
         is_horizontally_placed = word['x0'] > search_x_start and word['x0'] < search_x_end
         is_vertically_placed = word['top'] > search_y_start and word['top'] < search_y_end
         if is_horizontally_placed and is_vertically_placed:
@@ -219,7 +355,7 @@ def find_value_3_lines(anchor_last_word, all_words_on_page, page_width):
     value_words.sort(key=lambda w: (w['top'], w['x0']))
     return " ".join(w['text'] for w in value_words).strip()
 
-def find_value_below(anchor_first_word, anchor_last_word, all_words_on_page):
+def find_value_below(anchor_first_word, anchor_last_word, word_index):
     """
     For fields where the value is on the line(s) directly below the label.
     e.g. Safeguarding Flags
@@ -232,7 +368,7 @@ def find_value_below(anchor_first_word, anchor_last_word, all_words_on_page):
     search_x_end = anchor_last_word['x1'] + 100     # End to the right of the label, allowing for wider values
 
     value_words = []
-    for word in all_words_on_page:
+    for word in query_word_index(word_index, search_y_start, search_y_end):
         # Check if the word is vertically below the anchor
         is_vertically_placed = word['top'] > search_y_start and word['top'] < search_y_end
         # Check if the word is horizontally aligned with the anchor
@@ -248,111 +384,1510 @@ def find_value_below(anchor_first_word, anchor_last_word, all_words_on_page):
     value_words.sort(key=lambda w: (w['top'], w['x0']))
     return " ".join(w['text'] for w in value_words).strip()
 
+def find_field_value(field_config, label_words, word_index, page_width):
+    """
+    Picks the value finder for a field's "multi_line_type" and runs it
+    against the label's words (first word to last word).
+    """
+    multi_line_type = field_config.get("multi_line_type")
+    anchor_last_word = label_words[-1]
 
-# --- 3. MAIN EXTRACTION FUNCTION ---
-def extract_data_from_pdf_v3(pdf_path, master_config):
-    print(f"\n--- Processing file: {os.path.basename(pdf_path)} ---")
-    
-    extracted_data = {header: {} for header in MAJOR_HEADINGS}
+    if multi_line_type == "value_below":
+        return find_value_below(label_words[0], anchor_last_word, word_index)
+    elif multi_line_type == "3_line":
+        return find_value_3_lines(anchor_last_word, word_index, page_width)
+    elif multi_line_type == "2_line":
+        return find_value_2_lines(anchor_last_word, word_index, page_width)
+    else:
+        return find_value_singleline(anchor_last_word, word_index, page_width)
+
+
+# --- 3. LABEL AND HEADING MATCHING ---
+
+# Marks the end of a phrase inside a token trie. Word texts are always strings,
+# so None can never collide with a real token.
+_TRIE_END = None
+
+def build_token_trie(phrases):
+    """
+    Compiles a list of (phrase, payload) pairs into a token-level trie.
+    Each phrase is split into words, so "Town or city" becomes the path
+    "Town" -> "or" -> "city". The position of a phrase in the list is kept as
+    its priority, which lets the matcher reproduce the old first-in-list order.
+    """
+    trie = {}
+    for priority, (phrase, payload) in enumerate(phrases):
+        node = trie
+        phrase_parts = phrase.split()
+        for token in phrase_parts:
+            node = node.setdefault(token, {})
+        node.setdefault(_TRIE_END, []).append((priority, len(phrase_parts), payload))
+    return trie
+
+def match_token_trie(trie, page_words, start):
+    """
+    Walks the trie from page_words[start] and returns every phrase that matches
+    there as (priority, word_count, payload), sorted by priority.
+    Overlapping phrases are all returned (e.g. "Postcode with last UK GP" and
+    "Postcode"), so the caller can try them in config order as before.
+    """
+    matches = []
+    node = trie
+    for index in range(start, len(page_words)):
+        node = node.get(page_words[index]['text'])
+        if node is None:
+            break
+        matches.extend(node.get(_TRIE_END, ()))
+    matches.sort(key=lambda m: m[0])
+    return matches
+
+HEADING_TRIE = build_token_trie((header, header) for header in MAJOR_HEADINGS)
 
+# Position of each heading in document order.
+HEADING_ORDER = {header: n for n, header in enumerate(MAJOR_HEADINGS)}
+
+def build_label_trie(master_config):
+    """
+    Groups the field keys by label text (in config order) and compiles the labels into a trie.
+    """
     label_to_key_map = {}
     for key, config in master_config.items():
         for label_text in config["labels"]:
             if label_text not in label_to_key_map:
                 label_to_key_map[label_text] = []
             label_to_key_map[label_text].append(key)
+    return build_token_trie(label_to_key_map.items())
+
+# Compiled label tries by config fingerprint, so each config is compiled once per process.
+_LABEL_TRIES = {}
+
+def get_label_trie(master_config):
+    """
+    Returns the label trie for master_config, compiling it only the first time
+    that configuration is seen (like HEADING_TRIE, but per config).
+    """
+    fingerprint = config_fingerprint(master_config)
+    if fingerprint not in _LABEL_TRIES:
+        _LABEL_TRIES[fingerprint] = build_label_trie(master_config)
+    return _LABEL_TRIES[fingerprint]
+
+def past_last_relevant_section(current_section_header, remaining_keys, master_config):
+    """
+    True once the current section is at or after the last section (in
+    MAJOR_HEADINGS order) that still has fields left to find.
+    """
+    if current_section_header is None or not remaining_keys:
+        return False
+    last_needed = max(HEADING_ORDER.get(master_config[key]["section_header"], len(MAJOR_HEADINGS))
+                      for key in remaining_keys)
+    return HEADING_ORDER[current_section_header] >= last_needed
+
+
+# --- 4. PROFILING ---
+
+def new_extraction_metrics():
+    """
+    Empty metrics for one document. Stage times are in seconds; "template" is
+    the time spent in the layout-template path, if one is used, and "triage"
+    the first-page check, which includes reading that page's characters.
+    """
+    return {
+        "stages": {"open": 0.0, "triage": 0.0, "template": 0.0, "extract_words": 0.0, "matching": 0.0, "find_value": 0.0},
+        "pages": [],
+        "fields": {},
+    }
+
+def record_field_attempt(metrics, key, field_config, value, seconds):
+    """
+    Counts one value search for a field: a "match" is a label found in the right
+    section, which is then either a "hit" (value found) or "empty".
+    """
+    field_metrics = metrics["fields"].setdefault(key, {
+        "strategy": field_config.get("multi_line_type") or "singleline",
+        "matches": 0, "hits": 0, "empty": 0, "seconds": 0.0,
+    })
+    field_metrics["matches"] += 1
+    field_metrics["hits" if value else "empty"] += 1
+    field_metrics["seconds"] += seconds
+
+def merge_extraction_metrics(totals, metrics):
+    """
+    Adds one document's stage times and field counts into the run totals.
+    """
+    for stage, seconds in metrics["stages"].items():
+        totals["stages"][stage] = totals["stages"].get(stage, 0.0) + seconds
+    totals["page_count"] = totals.get("page_count", 0) + len(metrics["pages"])
+    for key, field_metrics in metrics["fields"].items():
+        total_field = totals["fields"].setdefault(key, dict(field_metrics, matches=0, hits=0, empty=0, seconds=0.0))
+        for name in ("matches", "hits", "empty", "seconds"):
+            total_field[name] += field_metrics[name]
+
+def print_metrics_summary(totals, document_count, field_rows=20):
+    """
+    Prints where the time went, per stage and for the slowest fields.
+    """
+    total_seconds = sum(totals["stages"].values())
+    print(f"\n--- PROFILE: {document_count} document(s), {totals.get('page_count', 0)} page(s) ---")
+    print(f"{'Stage':<15} {'Seconds':>10} {'Share':>7}")
+    for stage, seconds in totals["stages"].items():
+        share = seconds / total_seconds if total_seconds else 0.0
+        print(f"{stage:<15} {seconds:>10.3f} {share:>7.1%}")
+
+    print(f"\n{'Field':<38} {'Strategy':<12} {'Matches':>8} {'Hits':>6} {'Empty':>6} {'ms':>9}")
+    slowest = sorted(totals["fields"].items(), key=lambda item: item[1]["seconds"], reverse=True)
+    for key, field_metrics in slowest[:field_rows]:
+        print(f"{key:<38} {field_metrics['strategy']:<12} {field_metrics['matches']:>8} "
+              f"{field_metrics['hits']:>6} {field_metrics['empty']:>6} {field_metrics['seconds'] * 1000:>9.1f}")
+    never_found = [key for key, field_metrics in totals["fields"].items() if not field_metrics["hits"]]
+    if never_found:
+        print(f"Fields matched but never filled: {', '.join(never_found)}")
 
+
+# --- 5. MAIN EXTRACTION FUNCTION ---
+
+# First-page triage: a registration form shows at least this many of the
+# MAJOR_HEADINGS on its first page.
+TRIAGE_MIN_HEADINGS = 2
+
+# The headings with their spaces removed, for matching against raw page characters.
+TRIAGE_HEADINGS = ["".join(header.split()) for header in MAJOR_HEADINGS]
+
+class PDFRejected(Exception):
+    """
+    Raised when triage decides a file is not a registration form. The message is the reason.
+    """
+
+def is_password_error(error):
+    """
+    True if pdfplumber could not open the file because it is encrypted.
+    """
+    return isinstance(error, PDFPasswordIncorrect) or any(isinstance(arg, PDFPasswordIncorrect) for arg in error.args)
+
+def triage_first_page(pdf, min_headings=TRIAGE_MIN_HEADINGS):
+    """
+    Cheap check run before the word-level pass. Only the first page's
+    characters are read (and pdfplumber keeps them for the extraction that
+    follows), with no word grouping. Returns a rejection reason, or None if
+    the first page looks like a registration form.
+    """
+    if not pdf.pages:
+        return "no pages"
+    page = pdf.pages[0]
+    text = "".join("".join(char["text"] or "" for char in page.chars).split())
+    if not text:
+        return "image-only (no text layer on the first page)" if page.images else "no text on the first page"
+    found = sum(1 for heading in TRIAGE_HEADINGS if heading in text)
+    if found < min_headings:
+        return f"not a registration form ({found} of the {min_headings} required headings on the first page)"
+    return None
+
+def open_triaged_pdf(pdf_path, triage_min_headings, metrics=None):
+    """
+    Opens the PDF and, if triage_min_headings is set, raises PDFRejected for
+    encrypted files and for first pages that fail triage_first_page.
+    """
+    stage_started = time.perf_counter()
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            current_section_header = None
-            
-            for page_num, page in enumerate(pdf.pages):
-                page_words = page.extract_words(x_tolerance=2, y_tolerance=2)
-                if not page_words: continue
+        pdf = pdfplumber.open(pdf_path)
+    except Exception as e:
+        if triage_min_headings is not None and is_password_error(e):
+            raise PDFRejected("encrypted (password required)") from e
+        raise
+    if metrics is not None:
+        metrics["stages"]["open"] += time.perf_counter() - stage_started
+    if triage_min_headings is not None:
+        stage_started = time.perf_counter()
+        try:
+            rejection = triage_first_page(pdf, triage_min_headings)
+        except Exception:
+            pdf.close()
+            raise
+        if metrics is not None:
+            metrics["stages"]["triage"] += time.perf_counter() - stage_started
+        if rejection:
+            pdf.close()
+            raise PDFRejected(rejection)
+    return pdf
 
-                i = 0
-                while i < len(page_words):
-                    
-                    # First, check for a new major heading to set the current section context.
-                    found_new_section = False
-                    for header in MAJOR_HEADINGS:
-                        header_parts = header.split()
-                        if len(page_words) >= i + len(header_parts):
-                            sequence = " ".join(w['text'] for w in page_words[i:i+len(header_parts)])
-                            if sequence.strip() == header:
-                                current_section_header = header
-                                
-                                # If the heading is also a label (Ethnicity),
-                                # set the context but DON'T advance the pointer.
-                                # Let the code fall through to the label check below.
-                                if header == "Ethnicity" or header == "Safeguarding Flags":
-                                    break
-                                
-                                # For all other normal headings, advance the pointer
-                                # and flag that we need to skip to the next word.
-                                i += len(header_parts)
-                                found_new_section = True
-                                break
-                    
-                    if found_new_section:
-                        continue
+def rejection_reason(error):
+    """
+    The triage reason if a batch error string comes from PDFRejected, else None.
+    """
+    prefix = f"{PDFRejected.__name__}: "
+    return error[len(prefix):] if error and error.startswith(prefix) else None
+
+# In a merged PDF (several registrations in one file), each patient's record
+# starts where this heading appears again.
+RECORD_START_HEADING = MAJOR_HEADINGS[0]
+
+def new_record_state(master_config):
+    """
+    The per-record state carried from page to page: the values found so far,
+    the section being read and the fields that still have no value.
+    """
+    return {
+        "data": {header: {} for header in MAJOR_HEADINGS},
+        "current_section_header": None,
+        "remaining_keys": {key for key, config in master_config.items() if config.get("section_header")},
+    }
+
+def scan_page_words(page_words, start, page_num, page_width, record, master_config, label_trie,
+                    record_start_heading=None, layout_recorder=None, metrics=None, page_metrics=None):
+    """
+    Walks page_words from 'start', tracking the current section and filling
+    record with the first value found for each field.
 
-                    # Second, check for a field label to extract its value.
-                    found_label = False
-                    for label_text, field_keys in label_to_key_map.items():
-                        label_parts = label_text.split()
-                        if len(page_words) >= i + len(label_parts):
-                            sequence = " ".join(w['text'] for w in page_words[i:i+len(label_parts)])
-                            if sequence.strip() == label_text:
-                                for key in field_keys:
-                                    field_config = master_config[key]
-                                    field_section = field_config.get("section_header")
-                                    
-                                    if field_section and field_section == current_section_header:
-                                        
-                                        multi_line_type = field_config.get("multi_line_type")
-
-                                        if multi_line_type == "value_below":
-                                            anchor_first_word = page_words[i]
-                                            anchor_last_word = page_words[i + len(label_parts) - 1]
-                                            value = find_value_below(anchor_first_word, anchor_last_word, page_words)
-                                        elif multi_line_type == "3_line":
-                                            anchor_last_word = page_words[i + len(label_parts) - 1]
-                                            value = find_value_3_lines(anchor_last_word, page_words, page.width)
-                                        elif multi_line_type == "2_line":
-                                            anchor_last_word = page_words[i + len(label_parts) - 1]
-                                            value = find_value_2_lines(anchor_last_word, page_words, page.width)
-                                        else:
-                                            anchor_last_word = page_words[i + len(label_parts) - 1]
-                                            value = find_value_singleline(anchor_last_word, page_words, page.width)
-                                        
-                                        if value:
-                                            if extracted_data[field_section].get(key) is None:
-                                                extracted_data[field_section][key] = value.replace("\n", " ")
-                                            
-                                            # Advance pointer past the label's words
-                                            i += len(label_parts) 
-                                            found_label = True
-                                            break # break from the inner 'for key in field_keys' loop
-                                if found_label: break # break from the outer 'for label_text' loop
+    Returns (page_is_relevant, next_record_start). When record_start_heading is
+    given (record-splitting mode), the walk stops at that heading if the record
+    already has a section, and next_record_start is the heading's index in
+    page_words; otherwise it is None.
+    """
+    extracted_data = record["data"]
+    remaining_keys = record["remaining_keys"]
+    word_index = build_word_index(page_words)
+    page_is_relevant = False
+
+    i = start
+    # When splitting, keep reading after every field is found: the next record's heading is still needed.
+    while i < len(page_words) and (remaining_keys or record_start_heading):
+        
+        # First, check for a new major heading to set the current section context.
+        heading_matches = match_token_trie(HEADING_TRIE, page_words, i)
+        if heading_matches:
+            _, header_length, header = heading_matches[0]
+            if header == record_start_heading and record["current_section_header"] is not None:
+                return page_is_relevant, i
+            record["current_section_header"] = header
+            page_is_relevant = True
+            if layout_recorder is not None:
+                layout_recorder.append({"type": "heading", "page": page_num,
+                                        "words": compact_words(page_words[i:i + header_length])})
+
+            # If the heading is also a label (Ethnicity, Safeguarding Flags),
+            # set the context but DON'T advance the pointer.
+            # Let the code fall through to the label check below.
+            if header != "Ethnicity" and header != "Safeguarding Flags":
+                i += header_length
+                continue
+
+        # Second, check for a field label to extract its value.
+        found_label = False
+        for _, label_length, field_keys in match_token_trie(label_trie, page_words, i):
+            for key in field_keys:
+                field_config = master_config[key]
+                field_section = field_config.get("section_header")
+                
+                if field_section and field_section == record["current_section_header"]:
                     
-                    if found_label:
-                        continue # If we found and processed a label, start the while loop again
+                    page_is_relevant = True
+                    label_words = page_words[i:i + label_length]
+                    if metrics is not None:
+                        search_started = time.perf_counter()
+                        value = find_field_value(field_config, label_words, word_index, page_width)
+                        search_seconds = time.perf_counter() - search_started
+                        page_metrics["find_value"] += search_seconds
+                        record_field_attempt(metrics, key, field_config, value, search_seconds)
+                    else:
+                        value = find_field_value(field_config, label_words, word_index, page_width)
+                    if layout_recorder is not None:
+                        layout_recorder.append({"type": "field", "page": page_num, "key": key,
+                                                "label_words": compact_words(label_words)})
                     
-                    # If nothing was found at this position, move to the next word.
-                    i += 1
+                    if value:
+                        if extracted_data[field_section].get(key) is None:
+                            extracted_data[field_section][key] = value.replace("\n", " ")
+                            remaining_keys.discard(key)
+                        
+                        # Advance pointer past the label's words
+                        i += label_length
+                        found_label = True
+                        break # break from the inner 'for key in field_keys' loop
+            if found_label: break # break from the outer label loop
+        
+        if found_label:
+            continue # If we found and processed a label, start the while loop again
+        
+        # If nothing was found at this position, move to the next word.
+        i += 1
+
+    return page_is_relevant, None
+
+def read_page_words(page, page_num, word_engine, metrics):
+    """
+    Builds the page's words, then closes the page: only the words are needed
+    from here on, so its parsed objects are released straight away.
+    Returns (page_words, page_metrics); page_metrics is None unless profiling.
+    """
+    stage_started = time.perf_counter()
+    page_words = extract_page_words(page, word_engine)
+    page.close()
+    if metrics is None:
+        return page_words, None
+    page_metrics = {"page": page_num, "extract_words": time.perf_counter() - stage_started,
+                    "matching": 0.0, "find_value": 0.0}
+    metrics["pages"].append(page_metrics)
+    metrics["stages"]["extract_words"] += page_metrics["extract_words"]
+    return page_words, page_metrics
+
+def finish_page_metrics(metrics, page_metrics, matching_started):
+    """
+    Adds a page's matching and value-search time to the document's stage totals.
+    """
+    if metrics is None:
+        return
+    page_metrics["matching"] = time.perf_counter() - matching_started - page_metrics["find_value"]
+    metrics["stages"]["matching"] += page_metrics["matching"]
+    metrics["stages"]["find_value"] += page_metrics["find_value"]
+
+def extract_data_from_pdf_v3(pdf_path, master_config, verbose=True, raise_errors=False,
+                             layout_templates=None, layout_recorder=None, metrics=None, word_engine="pdfplumber",
+                             triage_min_headings=None):
+    if verbose:
+        print(f"\n--- Processing file: {os.path.basename(pdf_path)} ---")
+    
+    record = new_record_state(master_config)
+
+    label_trie = get_label_trie(master_config)
+
+    try:
+        with open_triaged_pdf(pdf_path, triage_min_headings, metrics) as pdf:
+            if layout_templates:
+                stage_started = time.perf_counter()
+                template_data = extract_with_template(pdf, master_config, layout_templates, metrics, word_engine)
+                if metrics is not None:
+                    metrics["stages"]["template"] += time.perf_counter() - stage_started
+                if template_data is not None:
+                    return template_data
+
+            remaining_keys = record["remaining_keys"]
+            
+            for page_num, page in enumerate(pdf.pages):
+                page_words, page_metrics = read_page_words(page, page_num, word_engine, metrics)
+                matching_started = time.perf_counter()
+                if not page_words:
+                    if past_last_relevant_section(record["current_section_header"], remaining_keys, master_config): break
+                    continue
+                page_is_relevant, _ = scan_page_words(page_words, 0, page_num, page.width, record, master_config,
+                                                      label_trie, layout_recorder=layout_recorder,
+                                                      metrics=metrics, page_metrics=page_metrics)
+                finish_page_metrics(metrics, page_metrics, matching_started)
+
+                # Stop once every field has a value (later matches can't overwrite them),
+                # or when a page with no headings or labels follows the last section
+                # that still has fields to find, e.g. an appended attachment.
+                if not remaining_keys:
+                    break
+                if not page_is_relevant and past_last_relevant_section(record["current_section_header"], remaining_keys, master_config):
+                    break
     
+    except PDFRejected:
+        # A rejection is a result for the caller to report, not a processing error.
+        raise
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error processing {pdf_path}: {e}")
         return None
 
-    cleaned_data = {section: fields for section, fields in extracted_data.items() if fields}
+    cleaned_data = {section: fields for section, fields in record["data"].items() if fields}
     
     return cleaned_data
 
+def extract_data_from_pdf_bytes(pdf_data, master_config, **kwargs):
+    """
+    In-memory entry point: takes the PDF as bytes or as a binary file-like
+    object, so uploads don't have to be written to disk first.
+    Accepts the same keyword arguments as extract_data_from_pdf_v3.
+    """
+    if isinstance(pdf_data, (bytes, bytearray, memoryview)):
+        pdf_data = io.BytesIO(pdf_data)
+    return extract_data_from_pdf_v3(pdf_data, master_config, **dict(kwargs, verbose=False))
+
+def iter_patient_records(pdf_path, master_config, record_start_heading=RECORD_START_HEADING,
+                         metrics=None, word_engine="pdfplumber", triage_min_headings=None):
+    """
+    Record-splitting mode for merged PDFs that hold many registrations.
+
+    A new record starts each time record_start_heading appears after the
+    current record has begun. Yields one dict per patient as soon as the next
+    record starts (or the file ends), without waiting for the rest of the file:
+        {"record": 1, "pages": [first, last], "extracted_data": {...}}
+    Pages are numbered from 1. Each page is closed once its words are built,
+    so memory stays flat however many pages the file has. Records with no
+    values (e.g. a cover sheet) are skipped. Errors, and PDFRejected when
+    triage_min_headings is set, are raised to the caller.
+    """
+    label_trie = get_label_trie(master_config)
+    record = new_record_state(master_config)
+    record_first_page = 1
+    record_count = 0
+
+    def finished_record(last_page):
+        cleaned_data = {section: fields for section, fields in record["data"].items() if fields}
+        if not cleaned_data:
+            return None
+        return {"record": record_count + 1, "pages": [record_first_page, last_page], "extracted_data": cleaned_data}
+
+    with open_triaged_pdf(pdf_path, triage_min_headings, metrics) as pdf:
+        for page_num, page in enumerate(pdf.pages):
+            page_words, page_metrics = read_page_words(page, page_num, word_engine, metrics)
+            matching_started = time.perf_counter()
+            start = 0
+            while page_words:
+                _, next_record_start = scan_page_words(page_words, start, page_num, page.width, record,
+                                                       master_config, label_trie, record_start_heading,
+                                                       metrics=metrics, page_metrics=page_metrics)
+                if next_record_start is None:
+                    break
+                finished = finished_record(page_num if next_record_start == 0 else page_num + 1)
+                if finished:
+                    record_count += 1
+                    yield finished
+                record = new_record_state(master_config)
+                record_first_page = page_num + 1
+                start = next_record_start
+            if page_words:
+                finish_page_metrics(metrics, page_metrics, matching_started)
+
+        finished = finished_record(len(pdf.pages))
+        if finished:
+            yield finished
+
+
+# --- 6. LAYOUT TEMPLATES ---
+
+# How far (in points) a heading may move from its position in the
+# reference document before the template is treated as not matching.
+TEMPLATE_POSITION_TOLERANCE = 1.0
+
+def compact_words(words):
+    """
+    Keeps only the text and bounding box of each word, for storing in a template.
+    """
+    return [{k: w[k] for k in ('text', 'x0', 'x1', 'top', 'bottom')} for w in words]
+
+def page_size_signature(pdf):
+    """
+    The cheap part of the layout fingerprint: page count and page sizes,
+    available without parsing any page content.
+    """
+    return ";".join(f"{float(page.width):.1f}x{float(page.height):.1f}" for page in pdf.pages)
+
+def learn_layout_template(pdf_path, master_config):
+    """
+    Runs the normal extraction on a reference document and records which pages
+    hold headings or field labels, and where each heading sits. Returns
+    (signature, template), or (None, None) if the reference could not be processed.
+
+    Pages of a matching document that had no headings or labels in the
+    reference (cover sheets, attachments) are skipped by the template path.
+    A reference with no headings at all (e.g. the wrong file) gives no template.
+    """
+    layout_recorder = []
+    data = extract_data_from_pdf_v3(pdf_path, master_config, verbose=False, layout_recorder=layout_recorder)
+    if data is None or not any(event["type"] == "heading" for event in layout_recorder):
+        return None, None
+
+    pages = {}
+    for event in layout_recorder:
+        page_template = pages.setdefault(str(event["page"]), {"headings": [], "fields": []})
+        if event["type"] == "heading":
+            page_template["headings"].append(event["words"])
+        elif event["key"] not in page_template["fields"]:
+            page_template["fields"].append(event["key"])
+
+    with pdfplumber.open(pdf_path) as pdf:
+        signature = page_size_signature(pdf)
+    template = {
+        "config_hash": config_fingerprint(master_config),
+        "reference_file": os.path.basename(pdf_path),
+        "pages": pages,
+    }
+    return signature, template
+
+def load_layout_templates(template_filename):
+    """
+    Reads the templates file, a JSON object mapping page-size signatures to templates.
+    """
+    if not os.path.exists(template_filename):
+        return {}
+    with open(template_filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_layout_templates(template_filename, layout_templates):
+    with open(template_filename, 'w', encoding='utf-8') as f:
+        json.dump(layout_templates, f, indent=2)
+
+def locate_template_words(words_by_text, template_words):
+    """
+    Finds the words of a heading at their template position.
+    Returns the matching page words, or None if any of them has moved or changed.
+    """
+    located = []
+    for template_word in template_words:
+        for word in words_by_text.get(template_word['text'], ()):
+            if (abs(word['x0'] - template_word['x0']) <= TEMPLATE_POSITION_TOLERANCE
+                    and abs(word['top'] - template_word['top']) <= TEMPLATE_POSITION_TOLERANCE):
+                located.append(word)
+                break
+        else:
+            return None
+    return located
+
+def extract_with_template(pdf, master_config, layout_templates, metrics=None, word_engine="pdfplumber"):
+    """
+    Page-skipping path for documents with a known layout. Only the pages that
+    held headings or labels in the reference are read, each with the normal
+    heading and label walk, so the results match the full extraction whenever
+    the skipped pages hold nothing to extract.
+
+    Returns None (so the caller falls back to the full heuristic) when there is
+    no template for the page sizes, the configuration has changed since it was
+    learned, a template page has no headings to check, any heading is not
+    where the template expects it, or a page is missing one of the field
+    labels the reference had there (e.g. rows that spilled onto a skipped page).
+    """
+    template = layout_templates.get(page_size_signature(pdf))
+    if (template is None or template["config_hash"] != config_fingerprint(master_config)
+            or not template["pages"]):
+        return None
+
+    # Kept apart until the template path succeeds, so a fallback doesn't count the same pages twice.
+    template_metrics = new_extraction_metrics() if metrics is not None else None
+    label_trie = get_label_trie(master_config)
+    record = new_record_state(master_config)
+
+    for page_num_text, page_template in sorted(template["pages"].items(), key=lambda item: int(item[0])):
+        if not page_template["headings"]:
+            return None
+        page_num = int(page_num_text)
+        page = pdf.pages[page_num]
+        page_words, page_metrics = read_page_words(page, page_num, word_engine, template_metrics)
+        matching_started = time.perf_counter()
+        words_by_text = {}
+        for word in page_words:
+            words_by_text.setdefault(word['text'], []).append(word)
+        for heading_words in page_template["headings"]:
+            if locate_template_words(words_by_text, heading_words) is None:
+                return None
+
+        page_events = []
+        scan_page_words(page_words, 0, page_num, page.width, record, master_config, label_trie,
+                        layout_recorder=page_events, metrics=template_metrics, page_metrics=page_metrics)
+        finish_page_metrics(template_metrics, page_metrics, matching_started)
+        if not record["remaining_keys"]:
+            break
+        # Older template files store each field as {"key": ..., "label_words": ...}.
+        expected_keys = {field["key"] if isinstance(field, dict) else field for field in page_template["fields"]}
+        matched_keys = {event["key"] for event in page_events if event["type"] == "field"}
+        if not expected_keys <= matched_keys:
+            return None
+
+    if metrics is not None:
+        # The time is already counted under the "template" stage by the caller.
+        metrics["pages"].extend(template_metrics["pages"])
+        metrics["fields"] = template_metrics["fields"]
+    return {section: fields for section, fields in record["data"].items() if fields}
+
+
+# --- 7. BATCH PROCESSING ---
+
+def run_batch_sequential(pdf_paths, master_config, extract_options=None, profile=False):
+    """
+    Processes the PDFs one at a time in this process and yields
+    (pdf_path, data, error, metrics) tuples. metrics is None unless profiling.
+    extract_options holds extra keyword arguments for extract_data_from_pdf_v3,
+    such as layout_templates, word_engine and triage_min_headings.
+    """
+    for pdf_path in pdf_paths:
+        metrics = new_extraction_metrics() if profile else None
+        try:
+            data = extract_data_from_pdf_v3(pdf_path, master_config, metrics=metrics, **(extract_options or {}))
+        except PDFRejected as e:
+            yield pdf_path, None, f"{type(e).__name__}: {e}", metrics
+            continue
+        yield pdf_path, data, None, metrics
+
+def run_split_sequential(pdf_paths, master_config, word_engine="pdfplumber", profile=False, triage_min_headings=None):
+    """
+    Record-splitting counterpart of run_batch_sequential for merged PDFs.
+    Yields (pdf_path, record, None, None) for each patient as soon as it is
+    read, then one (pdf_path, None, error, metrics) tuple to close the file.
+    Records yielded before an error are kept.
+    """
+    for pdf_path in pdf_paths:
+        print(f"\n--- Processing file: {os.path.basename(pdf_path)} ---")
+        metrics = new_extraction_metrics() if profile else None
+        error = None
+        try:
+            for record in iter_patient_records(pdf_path, master_config, metrics=metrics, word_engine=word_engine,
+                                               triage_min_headings=triage_min_headings):
+                yield pdf_path, record, None, None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        yield pdf_path, None, error, metrics
+
+def _extract_in_worker(pdf_path, master_config, extract_options, profile):
+    """
+    Runs inside a pool process. Errors are raised so they reach the parent
+    and are reported against the file instead of being printed by the worker.
+    """
+    metrics = new_extraction_metrics() if profile else None
+    data = extract_data_from_pdf_v3(pdf_path, master_config, verbose=False, raise_errors=True,
+                                    metrics=metrics, **(extract_options or {}))
+    return data, metrics
+
+def run_batch_parallel(pdf_paths, master_config, workers, timeout, extract_options=None, profile=False):
+    """
+    Spreads the PDFs across a pool of worker processes and yields
+    (pdf_path, data, error, metrics) tuples in the same order as pdf_paths.
+
+    At most one file per worker is in flight, so each file's timeout starts
+    when it is actually being processed. A file that times out (because its
+    worker hung or crashed) is reported as an error, and the pool is replaced
+    so the remaining files can carry on.
+    """
+    pending = deque(enumerate(pdf_paths))
+    in_flight = {}
+    finished = {}
+    next_index = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers:
+                index, pdf_path = pending.popleft()
+                in_flight[index] = (pool.apply_async(_extract_in_worker, (pdf_path, master_config, extract_options, profile)), time.monotonic())
+
+            timed_out = False
+            for index, (async_result, started) in list(in_flight.items()):
+                if async_result.ready():
+                    try:
+                        data, metrics = async_result.get()
+                        finished[index] = (data, None, metrics)
+                    except Exception as e:
+                        finished[index] = (None, f"{type(e).__name__}: {e}", None)
+                    del in_flight[index]
+                elif time.monotonic() - started > timeout:
+                    finished[index] = (None, f"Timed out after {timeout:g}s", None)
+                    del in_flight[index]
+                    timed_out = True
+
+            if timed_out:
+                # A hung worker can't be stopped on its own, so restart the pool
+                # and requeue the files that were still running alongside it.
+                pool.terminate()
+                pool.join()
+                pool = multiprocessing.Pool(workers)
+                for index in sorted(in_flight, reverse=True):
+                    pending.appendleft((index, pdf_paths[index]))
+                in_flight.clear()
+
+            while next_index in finished:
+                data, error, metrics = finished.pop(next_index)
+                yield pdf_paths[next_index], data, error, metrics
+                next_index += 1
+
+            if in_flight:
+                time.sleep(0.05)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def print_progress(done, total, failed, started):
+    """
+    Rewrites a single progress/throughput line on the console.
+    """
+    elapsed = time.monotonic() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    sys.stdout.write(f"\rProcessed {done}/{total} PDF(s), {failed} failed, {rate:.1f} docs/sec, {elapsed:.1f}s elapsed")
+    sys.stdout.flush()
+
+
+# --- 8. RESULT CACHE ---
+
+def config_fingerprint(master_config):
+    """
+    Hashes the field configuration, the headings and the extractor version.
+    Any change to these gives a different fingerprint and so a different cache key.
+    """
+    payload = json.dumps({
+        "fields": master_config,
+        "headings": MAJOR_HEADINGS,
+        "version": EXTRACTOR_VERSION,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def results_fingerprint(master_config, layout_templates=None, triage_min_headings=None):
+    """
+    The fingerprint cached results are stored under: the config fingerprint
+    plus the layout templates in use, because the template path skips pages
+    the full extraction would read, and the triage setting, because triage
+    turns some files into rejections. Runs without templates or triage have
+    their own fingerprint, so results from different settings are never mixed.
+    """
+    payload = json.dumps({
+        "config": config_fingerprint(master_config),
+        "layout_templates": layout_templates or None,
+        "triage_min_headings": triage_min_headings,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def result_cache_key(pdf_path, config_hash):
+    """
+    Builds the cache key from the PDF's content hash and the config fingerprint,
+    so a renamed but otherwise identical file is still a hit.
+    """
+    content_hash = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            content_hash.update(chunk)
+    return f"{content_hash.hexdigest()}-{config_hash[:16]}"
+
+def load_cached_result(cache_dir, key):
+    """
+    Returns (True, data, error) on a cache hit and (False, None, None) on a miss.
+    error is only set for a cached triage rejection, in the same form the batch
+    functions report it. A hit refreshes the entry's modification time, which
+    the eviction uses as its age.
+    """
+    entry_path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(entry_path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        os.utime(entry_path)
+    except (OSError, ValueError):
+        return False, None, None
+    if entry.get("rejected") is not None:
+        return True, None, f"{PDFRejected.__name__}: {entry['rejected']}"
+    return True, entry["extracted_data"], None
+
+def store_cached_result(cache_dir, key, data, rejected=None):
+    """
+    Writes a result, or a triage rejection reason, to the cache. The entry is
+    written to a temporary file first and then renamed, so a reader never
+    sees a half-written entry.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_path = os.path.join(cache_dir, f"{key}.json")
+    temp_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({"rejected": rejected} if rejected is not None else {"extracted_data": data}, f)
+    os.replace(temp_path, entry_path)
+
+def evict_cache(cache_dir, max_bytes, max_age_days):
+    """
+    Removes entries not used for more than max_age_days, then the least
+    recently used entries until the cache fits in max_bytes.
+    Returns the number of entries removed.
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".json"):
+            entry_path = os.path.join(cache_dir, filename)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+    entries.sort()
+
+    removed = 0
+    oldest_allowed = time.time() - max_age_days * 86400
+    total_bytes = sum(size for _, size, _ in entries)
+    for mtime, size, entry_path in entries:
+        if mtime >= oldest_allowed and total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(entry_path)
+        except OSError:
+            continue
+        total_bytes -= size
+        removed += 1
+    return removed
+
+def run_with_cache(pdf_paths, cache_dir, config_hash, extract_many, cache_stats):
+    """
+    Yields (pdf_path, data, error, metrics) in the order of pdf_paths, serving
+    cached results directly (with no metrics) and sending only the misses
+    through extract_many. New results and triage rejections are stored as
+    they arrive; cache_stats counts hits and misses.
+    """
+    cache_keys = {}
+    cached_results = {}
+    misses = []
+    for pdf_path in pdf_paths:
+        try:
+            cache_keys[pdf_path] = result_cache_key(pdf_path, config_hash)
+        except OSError:
+            misses.append(pdf_path)
+            continue
+        hit, data, error = load_cached_result(cache_dir, cache_keys[pdf_path])
+        if hit:
+            cached_results[pdf_path] = (data, error)
+        else:
+            misses.append(pdf_path)
+    cache_stats["hits"] += len(cached_results)
+    cache_stats["misses"] += len(misses)
+
+    extracted = extract_many(misses)
+    for pdf_path in pdf_paths:
+        if pdf_path in cached_results:
+            data, error = cached_results[pdf_path]
+            yield pdf_path, data, error, None
+            continue
+        pdf_path, data, error, metrics = next(extracted)
+        if pdf_path in cache_keys:
+            if data is not None and error is None:
+                store_cached_result(cache_dir, cache_keys[pdf_path], data)
+            elif rejection_reason(error):
+                store_cached_result(cache_dir, cache_keys[pdf_path], None, rejected=rejection_reason(error))
+        yield pdf_path, data, error, metrics
+
+
+# --- 9. OUTPUT ---
+
+def read_completed_sources(output_filename):
+    """
+    Returns the set of 'source_file' values already written to a JSONL output.
+    A partially written last line (e.g. from a crash mid-write) is cut off so
+    new records can be appended cleanly after it.
+    """
+    completed = set()
+    if not os.path.exists(output_filename):
+        return completed
+    valid_length = 0
+    with open(output_filename, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            completed.add(record.get("source_file"))
+            valid_length += len(line)
+    if valid_length < os.path.getsize(output_filename):
+        with open(output_filename, 'r+b') as f:
+            f.truncate(valid_length)
+    return completed
+
+def write_jsonl_record(f, record, fsync=False):
+    """
+    Appends one result as a single JSON line and flushes it, so finished
+    files survive a crash later in the run.
+    """
+    f.write(json.dumps(record) + "\n")
+    f.flush()
+    if fsync:
+        os.fsync(f.fileno())
+
+def remove_jsonl_records(output_filename, source_file):
+    """
+    Rewrites a JSONL output without the records for source_file, so a file
+    that is processed again keeps a single record. The new file is written
+    beside the old one and then renamed over it.
+    """
+    temp_path = f"{output_filename}.{os.getpid()}.tmp"
+    with open(output_filename, 'rb') as source, open(temp_path, 'wb') as target:
+        for line in source:
+            try:
+                if json.loads(line).get("source_file") == source_file:
+                    continue
+            except ValueError:
+                pass
+            target.write(line)
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(temp_path, output_filename)
+
+def flatten_record(record, master_config, columns):
+    """
+    Turns one output record into a flat row: source_file (and record, when
+    splitting merged PDFs) followed by one value per field key, or None.
+    """
+    row = {"source_file": record["source_file"]}
+    if "record" in columns:
+        row["record"] = record["record"]
+    for key, config in master_config.items():
+        row[key] = record["extracted_data"].get(config.get("section_header"), {}).get(key)
+    return row
+
+def open_bulk_sink(master_config, sqlite_path=None, csv_path=None, table="registrations",
+                   batch_size=500, split_records=False, append=False):
+    """
+    Opens the flat-row outputs. Rows are buffered and written batch_size at a
+    time: one transaction per batch for SQLite, one buffered write for CSV.
+
+    The SQLite table has a TEXT column per field key and is keyed on
+    source_file (plus record when splitting), so re-running a file replaces
+    its row instead of adding a duplicate. Columns for field keys added to the
+    config later are added to an existing table, but an existing table keyed
+    on different columns (e.g. created without split_records) raises
+    ValueError instead of silently collapsing rows. The CSV is started afresh
+    unless append is set (e.g. when resuming).
+    """
+    columns = ["source_file"] + (["record"] if split_records else []) + list(master_config)
+    sink = {"columns": columns, "batch_size": max(batch_size, 1), "rows": [],
+            "connection": None, "insert_sql": None, "csv_file": None, "csv_writer": None, "row_count": 0}
+
+    if sqlite_path:
+        connection = sqlite3.connect(sqlite_path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        quoted = {column: '"' + column.replace('"', '""') + '"' for column in columns}
+        key_columns = columns[:2] if split_records else columns[:1]
+        column_sql = ", ".join(f"{quoted[column]} {'INTEGER' if column == 'record' else 'TEXT'}" for column in columns)
+        table_sql = '"' + table.replace('"', '""') + '"'
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {table_sql} "
+                           f"({column_sql}, PRIMARY KEY ({', '.join(quoted[column] for column in key_columns)}))")
+        table_info = list(connection.execute(f"PRAGMA table_info({table_sql})"))
+        existing_key = [row[1] for row in sorted((row for row in table_info if row[5]), key=lambda row: row[5])]
+        if existing_key != key_columns:
+            connection.close()
+            raise ValueError(f"Table '{table}' in '{sqlite_path}' is keyed on ({', '.join(existing_key) or 'no key'}), "
+                             f"but this run needs ({', '.join(key_columns)}). Use another --sqlite-table or database "
+                             f"for {'--split-records' if split_records else 'runs without --split-records'}.")
+        existing = {row[1] for row in table_info}
+        for column in columns:
+            if column not in existing:
+                connection.execute(f"ALTER TABLE {table_sql} ADD COLUMN {quoted[column]} TEXT")
+        connection.commit()
+        sink["connection"] = connection
+        sink["insert_sql"] = (f"INSERT OR REPLACE INTO {table_sql} ({', '.join(quoted[column] for column in columns)}) "
+                              f"VALUES ({', '.join('?' for _ in columns)})")
+
+    if csv_path:
+        write_header = not (append and os.path.exists(csv_path) and os.path.getsize(csv_path) > 0)
+        sink["csv_file"] = open(csv_path, 'a' if append else 'w', encoding='utf-8', newline='')
+        sink["csv_writer"] = csv.DictWriter(sink["csv_file"], fieldnames=columns)
+        if write_header:
+            sink["csv_writer"].writeheader()
+
+    return sink
+
+def add_to_bulk_sink(sink, record, master_config):
+    """
+    Queues one output record as a flat row, writing the batch once it is full.
+    """
+    sink["rows"].append(flatten_record(record, master_config, sink["columns"]))
+    if len(sink["rows"]) >= sink["batch_size"]:
+        flush_bulk_sink(sink)
+
+def flush_bulk_sink(sink):
+    """
+    Writes the queued rows: a single transaction for SQLite, then the CSV lines.
+    """
+    rows = sink["rows"]
+    if not rows:
+        return
+    if sink["connection"] is not None:
+        with sink["connection"]:
+            sink["connection"].executemany(sink["insert_sql"],
+                                           ([row[column] for column in sink["columns"]] for row in rows))
+    if sink["csv_writer"] is not None:
+        sink["csv_writer"].writerows(rows)
+        sink["csv_file"].flush()
+    sink["row_count"] += len(rows)
+    sink["rows"] = []
+
+def close_bulk_sink(sink):
+    """
+    Writes any rows still queued and closes the database and CSV file.
+    """
+    try:
+        flush_bulk_sink(sink)
+    finally:
+        if sink["connection"] is not None:
+            sink["connection"].close()
+        if sink["csv_file"] is not None:
+            sink["csv_file"].close()
+
+
+# --- 10. WATCH-FOLDER SERVICE ---
+
+def _init_service_worker():
+    """
+    Pool initializer for the long-running services (watch folder and HTTP).
+    Workers ignore Ctrl+C so the parent decides when to stop them, and drop any
+    SIGTERM handler inherited from the parent so the pool can still terminate them.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def scan_for_ready_files(pdf_directory, processed, candidates, busy_names):
+    """
+    Polls the folder and returns the names of PDFs that are new (or changed)
+    and fully written. A file counts as fully written once its size and
+    modification time are unchanged since the previous poll.
+
+    processed maps names to the (size, mtime) they were processed with, or to
+    None for files in the output from an earlier run that has no state entry. candidates holds
+    the (size, mtime) seen on the previous poll and is updated in place.
+    """
+    ready = []
+    present = set()
+    for filename in sorted(os.listdir(pdf_directory)):
+        if not filename.lower().endswith(".pdf") or filename in busy_names:
+            continue
+        try:
+            stat = os.stat(os.path.join(pdf_directory, filename))
+        except OSError:
+            continue
+        present.add(filename)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if filename in processed and processed[filename] in (None, signature):
+            continue
+        if candidates.get(filename) == signature and stat.st_size > 0:
+            ready.append((filename, signature))
+        else:
+            candidates[filename] = signature
+    for filename in list(candidates):
+        if filename not in present:
+            del candidates[filename]
+    return ready
+
+def read_watch_state(state_filename):
+    """
+    Reads the watch state file: one JSON line per finished file with the
+    (size, mtime) it was processed with, whatever the outcome. Later lines
+    win. Returns {filename: (size, mtime_ns)}. As with the output, a partially
+    written last line is cut off so new entries can be appended after it.
+    """
+    signatures = {}
+    if not os.path.exists(state_filename):
+        return signatures
+    valid_length = 0
+    with open(state_filename, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            valid_length += len(line)
+            try:
+                entry = json.loads(line)
+                signatures[entry["source_file"]] = (entry["size"], entry["mtime_ns"])
+            except (ValueError, KeyError, TypeError):
+                continue
+    if valid_length < os.path.getsize(state_filename):
+        with open(state_filename, 'r+b') as f:
+            f.truncate(valid_length)
+    return signatures
+
+def watch_folder(pdf_directory, master_config, output_filename, workers, timeout,
+                 poll_interval=2.0, max_queue=None, extract_options=None):
+    """
+    Runs until interrupted. It watches pdf_directory, queues new PDFs once
+    they are fully written, and extracts them on a pool of warm worker
+    processes. Each result is appended to the JSONL output as soon as it is ready.
+
+    The queue holds at most max_queue files (waiting or in progress). Files
+    beyond that are left in the folder and picked up by a later poll. On
+    Ctrl+C or SIGTERM no new files are started, the files in progress are
+    finished and written, and the service exits.
+
+    Every finished file (including errors, timeouts and files with no fields)
+    is noted in "<output>.state" with the size and mtime it was processed
+    with, so a restart only picks up files that are new or have changed. A
+    changed file's new record replaces its old one in the output.
+    """
+    max_queue = max_queue or workers * 4
+    stop = {"requested": False}
+
+    def request_stop(signum, frame):
+        if not stop["requested"]:
+            print("\nShutdown requested: finishing the files in progress...")
+        stop["requested"] = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    state_filename = f"{output_filename}.state"
+    written = read_completed_sources(output_filename)
+    processed = {filename: None for filename in written}
+    processed.update(read_watch_state(state_filename))
+    candidates = {}
+    queue = deque()
+    in_flight = {}
+    processed_count = 0
+    next_poll = 0.0
+
+    print(f"Watching '{pdf_directory}' with {workers} worker(s); results go to '{output_filename}'. Press Ctrl+C to stop.")
+    pool = multiprocessing.Pool(workers, initializer=_init_service_worker)
+    output_file = open(output_filename, 'a', encoding='utf-8')
+    state_file = open(state_filename, 'a', encoding='utf-8')
+    try:
+        while in_flight or not stop["requested"]:
+            now = time.monotonic()
+            if not stop["requested"] and now >= next_poll:
+                busy_names = {filename for filename, _, _ in queue} | set(in_flight)
+                for filename, file_signature in scan_for_ready_files(pdf_directory, processed, candidates, busy_names):
+                    if len(queue) + len(in_flight) >= max_queue:
+                        break
+                    queue.append((filename, file_signature, now))
+                    del candidates[filename]
+                next_poll = now + poll_interval
+
+            while queue and len(in_flight) < workers and not stop["requested"]:
+                filename, file_signature, detected = queue.popleft()
+                pdf_path = os.path.join(pdf_directory, filename)
+                async_result = pool.apply_async(_extract_in_worker, (pdf_path, master_config, extract_options, False))
+                in_flight[filename] = (async_result, file_signature, detected, time.monotonic())
+
+            timed_out = False
+            for filename, (async_result, file_signature, detected, started) in list(in_flight.items()):
+                if async_result.ready():
+                    try:
+                        data, _ = async_result.get()
+                        error = None
+                    except Exception as e:
+                        data, error = None, f"{type(e).__name__}: {e}"
+                elif time.monotonic() - started > timeout:
+                    data, error = None, f"Timed out after {timeout:g}s"
+                    timed_out = True
+                else:
+                    continue
+                del in_flight[filename]
+                processed[filename] = file_signature
+                latency = time.monotonic() - detected
+                stamp = time.strftime("%H:%M:%S")
+                if rejection_reason(error):
+                    print(f"[{stamp}] Rejected {filename}: {rejection_reason(error)}")
+                elif error:
+                    print(f"[{stamp}] Error processing {filename}: {error}")
+                elif data:
+                    if filename in written:
+                        # A changed file: drop its earlier record so the output keeps one per file.
+                        output_file.close()
+                        remove_jsonl_records(output_filename, filename)
+                        output_file = open(output_filename, 'a', encoding='utf-8')
+                    write_jsonl_record(output_file, {"source_file": filename, "extracted_data": data}, fsync=True)
+                    written.add(filename)
+                    processed_count += 1
+                    field_count = sum(len(fields) for fields in data.values())
+                    print(f"[{stamp}] {filename}: {field_count} field(s) in {latency:.1f}s")
+                else:
+                    print(f"[{stamp}] {filename}: no fields found ({latency:.1f}s)")
+                write_jsonl_record(state_file, {"source_file": filename, "size": file_signature[0],
+                                                "mtime_ns": file_signature[1]})
+
+            if timed_out:
+                # Same as the batch mode: replace the pool and retry the other files it was running.
+                pool.terminate()
+                pool.join()
+                pool = multiprocessing.Pool(workers, initializer=_init_service_worker)
+                for filename, (_, file_signature, detected, _) in in_flight.items():
+                    queue.appendleft((filename, file_signature, detected))
+                in_flight.clear()
+
+            time.sleep(0.05)
+    finally:
+        pool.terminate()
+        pool.join()
+        output_file.close()
+        state_file.close()
+    print(f"Stopped. {processed_count} PDF(s) written to '{output_filename}' during this run.")
+
+
+# --- 11. HTTP SERVICE ---
+
+# Uploads larger than this are rejected with 413.
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+def _extract_bytes_in_worker(pdf_data, master_config, extract_options):
+    """
+    Runs inside a pool process for the HTTP service. Returns the data and the
+    time the extraction itself took; errors are raised back to the request.
+    """
+    started = time.perf_counter()
+    data = extract_data_from_pdf_bytes(pdf_data, master_config, raise_errors=True, **(extract_options or {}))
+    return data, time.perf_counter() - started
+
+class ExtractionRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /extract  - body is the raw PDF; returns the section/field JSON and latency metrics.
+    GET  /health   - liveness check.
+    GET  /metrics  - request counts and latency percentiles since start-up.
+    """
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self.send_json(200, self.server.latency_summary())
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/extract":
+            self.send_json(404, {"error": "Not found"})
+            return
+        received = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.send_json(411, {"error": "Content-Length is required"})
+            return
+        if length <= 0 or length > MAX_UPLOAD_BYTES:
+            self.send_json(413, {"error": f"Upload must be between 1 and {MAX_UPLOAD_BYTES} bytes"})
+            return
+        # Refuse before reading the body, so uploads can't pile up in memory.
+        if not self.server.pending_slots.acquire(blocking=False):
+            self.close_connection = True
+            self.server.record_request(503, time.perf_counter() - received)
+            self.send_json(503, {"error": "Too many requests in progress, try again later"})
+            return
+        try:
+            pdf_data = self.rfile.read(length)
+            data, extract_seconds = self.server.run_extraction(pdf_data)
+            status, body = 200, {"extracted_data": data or {}}
+        except multiprocessing.TimeoutError:
+            extract_seconds = None
+            status, body = 504, {"error": f"Timed out after {self.server.timeout:g}s"}
+        except Exception as e:
+            extract_seconds = None
+            status, body = 422, {"error": f"{type(e).__name__}: {e}"}
+        finally:
+            self.server.pending_slots.release()
+
+        latency = time.perf_counter() - received
+        body["metrics"] = {"latency_ms": round(latency * 1000, 1)}
+        if extract_seconds is not None:
+            body["metrics"]["extract_ms"] = round(extract_seconds * 1000, 1)
+            body["metrics"]["queue_ms"] = round(max(latency - extract_seconds, 0.0) * 1000, 1)
+        self.server.record_request(status, latency)
+        self.send_json(status, body)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class ExtractionHTTPServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server that hands every upload to a shared pool of warm
+    worker processes, and keeps latency figures for the /metrics endpoint.
+
+    At most max_pending uploads are accepted at once (the rest get 503), and
+    only as many jobs as there are workers are on the pool at a time, so the
+    timeout measures the extraction itself. A job that runs past the timeout
+    gets the pool replaced, as in the batch mode, and the other running jobs
+    are resubmitted to the new pool.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, master_config, workers, timeout, extract_options=None, max_pending=None):
+        super().__init__(address, ExtractionRequestHandler)
+        self.master_config = master_config
+        self.extract_options = extract_options
+        self.timeout = timeout
+        self.workers = workers
+        self.pool = multiprocessing.Pool(workers, initializer=_init_service_worker)
+        self.pool_lock = threading.Lock()
+        self.in_flight = {}
+        self.worker_slots = threading.Semaphore(workers)
+        self.pending_slots = threading.BoundedSemaphore(max_pending or workers * 4)
+        self.stats_lock = threading.Lock()
+        self.status_counts = {}
+        self.recent_latencies = deque(maxlen=1000)
+
+    def run_extraction(self, pdf_data):
+        """
+        Runs one upload on the pool and returns (data, extract_seconds).
+        Waits for a free worker first. Raises multiprocessing.TimeoutError if
+        the job runs longer than the timeout, and the job's own error if it fails.
+        """
+        with self.worker_slots:
+            job = {"args": (pdf_data, self.master_config, self.extract_options)}
+            with self.pool_lock:
+                job["async_result"] = self.pool.apply_async(_extract_bytes_in_worker, job["args"])
+                job["started"] = time.monotonic()
+                self.in_flight[id(job)] = job
+            try:
+                while True:
+                    with self.pool_lock:
+                        async_result, started = job["async_result"], job["started"]
+                    remaining = started + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        with self.pool_lock:
+                            # Another request may have replaced the pool and resubmitted this job meanwhile.
+                            hung = job["async_result"] is async_result
+                            if hung:
+                                del self.in_flight[id(job)]
+                                self.replace_pool()
+                        if hung:
+                            raise multiprocessing.TimeoutError()
+                        continue
+                    try:
+                        return async_result.get(min(remaining, 0.5))
+                    except multiprocessing.TimeoutError:
+                        continue
+            finally:
+                with self.pool_lock:
+                    self.in_flight.pop(id(job), None)
+
+    def replace_pool(self):
+        """
+        Called with pool_lock held after a job hung. A hung worker can't be
+        stopped on its own, so the whole pool is replaced and the other jobs
+        that were running are resubmitted with a fresh start time.
+        """
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = multiprocessing.Pool(self.workers, initializer=_init_service_worker)
+        for job in self.in_flight.values():
+            job["async_result"] = self.pool.apply_async(_extract_bytes_in_worker, job["args"])
+            job["started"] = time.monotonic()
+
+    def record_request(self, status, latency):
+        with self.stats_lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self.recent_latencies.append(latency)
+
+    def latency_summary(self):
+        with self.stats_lock:
+            latencies = sorted(self.recent_latencies)
+            status_counts = dict(self.status_counts)
+
+        def latency_ms(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 1)
+
+        return {
+            "requests": sum(status_counts.values()),
+            "status_counts": {str(status): count for status, count in sorted(status_counts.items())},
+            "latency_ms": {"p50": latency_ms(0.50), "p95": latency_ms(0.95), "p99": latency_ms(0.99)},
+        }
+
+    def server_close(self):
+        super().server_close()
+        with self.pool_lock:
+            self.pool.terminate()
+            self.pool.join()
+
+def _stop_on_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+def serve_http(host, port, master_config, workers, timeout, extract_options=None, max_pending=None):
+    """
+    Runs the local extraction service until Ctrl+C or SIGTERM.
+    """
+    server = ExtractionHTTPServer((host, port), master_config, workers, timeout, extract_options, max_pending)
+    signal.signal(signal.SIGTERM, _stop_on_sigterm)
+    print(f"Serving PDF extraction on http://{host}:{port}/extract with {workers} worker(s). Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping the extraction service...")
+    finally:
+        server.server_close()
+
+
+# --- 12. MAIN EXECUTION ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract patient registration data from the PDFs in 'pdf_documents'.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes. Values above 1 enable parallel batch mode.")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="Seconds a single PDF may take in parallel batch mode before it is reported as failed.")
+    parser.add_argument("--format", choices=["json", "jsonl"], default="json",
+                        help="'json' writes one array at the end; 'jsonl' streams one record per PDF as it finishes.")
+    parser.add_argument("--output", default=None,
+                        help="Output file (default: extracted_output.json or extracted_output.jsonl).")
+    parser.add_argument("--resume", action="store_true",
+                        help="With --format jsonl, skip PDFs already in the output file and append the rest.")
+    parser.add_argument("--fsync-every", type=int, default=50,
+                        help="With --format jsonl, fsync the output after this many records.")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory for a persistent result cache. Unchanged PDFs are then not re-parsed.")
+    parser.add_argument("--cache-max-mb", type=float, default=500,
+                        help="Size limit of the result cache in megabytes.")
+    parser.add_argument("--cache-max-age-days", type=float, default=30,
+                        help="Cache entries not used for this many days are removed.")
+    parser.add_argument("--template-file", default=None,
+                        help="JSON file of learned layout templates. Matching documents take the fast template path.")
+    parser.add_argument("--learn-template", metavar="REFERENCE_PDF", default=None,
+                        help="Learn a layout template from a fully completed reference PDF, save it to --template-file and exit.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running, and extract new PDFs as they arrive in 'pdf_documents' (JSONL output).")
+    parser.add_argument("--poll-interval", type=float, default=2.0,
+                        help="With --watch, seconds between folder scans.")
+    parser.add_argument("--max-queue", type=int, default=None,
+                        help="With --watch, most files waiting or in progress at once. With --serve, most uploads "
+                             "accepted at once; more get 503 (default: 4 per worker).")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run a local HTTP service that extracts PDFs uploaded to POST /extract.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="With --serve, the address to listen on.")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="With --serve, the port to listen on.")
+    parser.add_argument("--word-engine", choices=["pdfplumber", "fast"], default="pdfplumber",
+                        help="How page text is grouped into words. 'fast' needs NumPy and gives the same words as 'pdfplumber'.")
+    parser.add_argument("--sqlite", default=None,
+                        help="Also write one flat row per result (a column per field) into this SQLite database.")
+    parser.add_argument("--sqlite-table", default="registrations",
+                        help="With --sqlite, the table to create or update. Rows are replaced by source file.")
+    parser.add_argument("--csv", dest="csv_output", default=None,
+                        help="Also write one flat row per result (a column per field) to this CSV file.")
+    parser.add_argument("--sink-batch-size", type=int, default=500,
+                        help="With --sqlite or --csv, how many rows to write per transaction.")
+    parser.add_argument("--triage", action="store_true",
+                        help="Check each PDF's first page before the full extraction and reject encrypted, "
+                             "image-only and non-registration files.")
+    parser.add_argument("--triage-min-headings", type=int, default=TRIAGE_MIN_HEADINGS,
+                        help="With --triage, how many MAJOR_HEADINGS the first page must show.")
+    parser.add_argument("--rejected-file", default="rejected_files.json",
+                        help="With --triage, where to save the rejected files and their reasons.")
+    parser.add_argument("--split-records", action="store_true",
+                        help=f"Treat each PDF as several merged registrations and output one record per patient, "
+                             f"starting a new one at each '{RECORD_START_HEADING}' heading.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record per-stage timings and per-field match counts, and print a summary at the end.")
+    parser.add_argument("--metrics-file", default="extraction_metrics.json",
+                        help="With --profile, where to save the per-document and total metrics as JSON.")
+    args = parser.parse_args(argv)
+    if args.resume and args.format != "jsonl":
+        parser.error("--resume requires --format jsonl")
+    if args.learn_template and not args.template_file:
+        parser.error("--learn-template requires --template-file")
+    if args.word_engine == "fast" and np is None:
+        parser.error("--word-engine fast requires NumPy (pip install numpy)")
+    if (args.sqlite or args.csv_output) and (args.watch or args.serve):
+        parser.error("--sqlite and --csv cannot be combined with --watch or --serve")
+    if args.split_records:
+        for option, used in (("--workers", args.workers > 1), ("--resume", args.resume), ("--cache-dir", args.cache_dir),
+                             ("--template-file", args.template_file), ("--watch", args.watch), ("--serve", args.serve)):
+            if used:
+                parser.error(f"--split-records cannot be combined with {option}")
+
+    layout_templates = load_layout_templates(args.template_file) if args.template_file else None
+    if args.learn_template:
+        signature, template = learn_layout_template(args.learn_template, FIELDS_TO_EXTRACT)
+        if template is None:
+            print(f"Error: could not learn a layout template from '{args.learn_template}'.")
+            return
+        layout_templates[signature] = template
+        save_layout_templates(args.template_file, layout_templates)
+        field_count = sum(len(page_template["fields"]) for page_template in template["pages"].values())
+        print(f"Learned a layout template covering {field_count} field(s) on {len(template['pages'])} page(s) "
+              f"from '{args.learn_template}' and saved it to '{args.template_file}'.")
+        return
+
+    triage_min_headings = args.triage_min_headings if args.triage else None
+    extract_options = {"layout_templates": layout_templates, "word_engine": args.word_engine,
+                       "triage_min_headings": triage_min_headings}
+
+    if args.serve:
+        serve_http(args.host, args.port, FIELDS_TO_EXTRACT, max(args.workers, 1), args.timeout, extract_options,
+                   args.max_queue)
+        return
+
+    output_filename = args.output or ("extracted_output.jsonl" if args.format == "jsonl" or args.watch else "extracted_output.json")
 
-# --- 4. MAIN EXECUTION ---
-def main():
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
     except NameError:
@@ -365,17 +1900,123 @@ def main():
         print("Please create a subdirectory named 'pdf_documents' in the same folder as the script and place your PDF files inside it.")
         return
 
+    if args.watch:
+        watch_folder(pdf_directory, FIELDS_TO_EXTRACT, output_filename, max(args.workers, 1), args.timeout,
+                     args.poll_interval, args.max_queue, extract_options)
+        return
+
     all_results = []
+    failed_files = []
+    rejected_files = []
     print(f"Searching for PDF files in: {pdf_directory}")
-    for filename in sorted(os.listdir(pdf_directory)):
-        if filename.lower().endswith(".pdf"):
-            pdf_path = os.path.join(pdf_directory, filename)
-            data = extract_data_from_pdf_v3(pdf_path, FIELDS_TO_EXTRACT)
+    pdf_paths = [os.path.join(pdf_directory, filename) for filename in sorted(os.listdir(pdf_directory))
+                 if filename.lower().endswith(".pdf")]
+
+    if args.resume:
+        completed_sources = read_completed_sources(output_filename)
+        pdf_paths = [pdf_path for pdf_path in pdf_paths if os.path.basename(pdf_path) not in completed_sources]
+        print(f"Resuming '{output_filename}': {len(completed_sources)} PDF(s) already done, {len(pdf_paths)} remaining.")
+
+    if args.split_records:
+        extract_many = lambda paths: run_split_sequential(paths, FIELDS_TO_EXTRACT, args.word_engine, args.profile,
+                                                          triage_min_headings)
+    elif args.workers > 1:
+        print(f"Processing {len(pdf_paths)} PDF(s) with {args.workers} worker processes...")
+        extract_many = lambda paths: run_batch_parallel(paths, FIELDS_TO_EXTRACT, args.workers, args.timeout,
+                                                        extract_options, args.profile)
+    else:
+        extract_many = lambda paths: run_batch_sequential(paths, FIELDS_TO_EXTRACT, extract_options, args.profile)
+
+    cache_stats = {"hits": 0, "misses": 0}
+    if args.cache_dir:
+        results_hash = results_fingerprint(FIELDS_TO_EXTRACT, layout_templates, triage_min_headings)
+        results = run_with_cache(pdf_paths, args.cache_dir, results_hash, extract_many, cache_stats)
+    else:
+        results = extract_many(pdf_paths)
+
+    bulk_sink = None
+    if args.sqlite or args.csv_output:
+        try:
+            bulk_sink = open_bulk_sink(FIELDS_TO_EXTRACT, args.sqlite, args.csv_output, args.sqlite_table,
+                                       args.sink_batch_size, args.split_records, append=args.resume)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+    output_file = None
+    if args.format == "jsonl":
+        output_file = open(output_filename, 'a' if args.resume else 'w', encoding='utf-8')
+
+    saved_count = 0
+    document_metrics = []
+    metrics_totals = {"stages": {}, "fields": {}}
+    started = time.monotonic()
+    try:
+        for done, (pdf_path, data, error, metrics) in enumerate(results, start=1):
+            if rejection_reason(error):
+                rejected_files.append({"source_file": os.path.basename(pdf_path), "reason": rejection_reason(error)})
+            elif error:
+                failed_files.append((os.path.basename(pdf_path), error))
+            if metrics is not None:
+                document_metrics.append(dict(metrics, source_file=os.path.basename(pdf_path)))
+                merge_extraction_metrics(metrics_totals, metrics)
             if data:
-                all_results.append({
-                    "source_file": filename,
-                    "extracted_data": data
-                })
+                if args.split_records:
+                    # data is one patient's {"record", "pages", "extracted_data"}.
+                    record = {"source_file": os.path.basename(pdf_path), **data}
+                else:
+                    record = {
+                        "source_file": os.path.basename(pdf_path),
+                        "extracted_data": data
+                    }
+                if output_file:
+                    saved_count += 1
+                    write_jsonl_record(output_file, record, fsync=args.fsync_every > 0 and saved_count % args.fsync_every == 0)
+                else:
+                    all_results.append(record)
+                if bulk_sink:
+                    add_to_bulk_sink(bulk_sink, record, FIELDS_TO_EXTRACT)
+            if args.workers > 1:
+                print_progress(done, len(pdf_paths), len(failed_files), started)
+    finally:
+        if output_file:
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            output_file.close()
+        if bulk_sink:
+            close_bulk_sink(bulk_sink)
+    if args.workers > 1 and pdf_paths:
+        print()
+
+    for filename, error in failed_files:
+        print(f"Error processing {filename}: {error}")
+
+    if args.triage:
+        for rejected in rejected_files:
+            print(f"Rejected {rejected['source_file']}: {rejected['reason']}")
+        with open(args.rejected_file, 'w', encoding='utf-8') as f:
+            json.dump(rejected_files, f, indent=2)
+        print(f"Triage: {len(rejected_files)} file(s) rejected, listed in '{args.rejected_file}'.")
+
+    if args.cache_dir:
+        evicted = evict_cache(args.cache_dir, args.cache_max_mb * 1024 * 1024, args.cache_max_age_days)
+        print(f"Cache: {cache_stats['hits']} hit(s), {cache_stats['misses']} miss(es), {evicted} entr{'y' if evicted == 1 else 'ies'} evicted.")
+
+    if bulk_sink:
+        targets = [f"table '{args.sqlite_table}' in '{args.sqlite}'" if args.sqlite else None,
+                   f"'{args.csv_output}'" if args.csv_output else None]
+        print(f"{bulk_sink['row_count']} row(s) written to {' and '.join(t for t in targets if t)}.")
+
+    if args.profile:
+        print_metrics_summary(metrics_totals, len(document_metrics))
+        with open(args.metrics_file, 'w', encoding='utf-8') as f:
+            json.dump({"documents": document_metrics, "totals": metrics_totals}, f, indent=2)
+        print(f"Metrics saved to '{args.metrics_file}'.")
+
+    unit = "record(s)" if args.split_records else "PDF(s)"
+    if output_file:
+        print("\n\n--- EXTRACTION COMPLETE ---")
+        print(f"\nResults from {saved_count} {unit} have been streamed to '{output_filename}' in the main script directory.")
+        return
 
     if not all_results:
         print("\nNo PDF files were found or successfully processed in the directory.")
@@ -383,10 +2024,9 @@ def main():
 
     print("\n\n--- EXTRACTION COMPLETE ---")
 
-    output_filename = "extracted_output.json"
     with open(output_filename, 'w', encoding='utf-8') as f:
         json.dump(all_results, f, indent=2)
-    print(f"\nResults from {len(all_results)} PDF(s) have been saved to '{output_filename}' in the main script directory.")
+    print(f"\nResults from {len(all_results)} {unit} have been saved to '{output_filename}' in the main script directory.")
 
 
 if __name__ == "__main__":